@@ -1,16 +1,39 @@
 #!/usr/bin/env python3
 
 import os
-import requests
 import logging
-import csv
-from collections import defaultdict
+import threading
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from numba import njit
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession, NEVER_EXPIRE
+from urllib3.util.retry import Retry
+
+from config import MAX_REQUESTS_PER_SECOND
 
 # --- Configuration ---
 SPORTSRADAR_API_KEY   = os.getenv("SPORTSRADAR_API_KEY")
 SPORTSRADAR_BASE_URL  = "https://api.sportradar.us/nhl/production/v7/en"
 SEASON                = "2024"
 PERIOD_LENGTH_SECONDS = 20 * 60  # 20 minute periods
+REQUEST_TIMEOUT       = 10       # seconds
+MAX_WORKERS           = 10       # concurrent API fetches (play-by-play, profiles)
+MAX_429_RETRIES       = 5
+CACHE_PATH            = "nhl_cache.sqlite"
+FINAL_GAME_STATUSES   = ("closed", "complete")
+MAX_SIDE_PLAYERS      = 63       # on-ice bitmask width (int64 minus sign bit)
+CSV_COLUMNS           = ["game_id", "period", "clock_seconds", "player_id", "on_off", "xg"]
+# play-by-play columns read downstream; added as NaN when a game lacks them
+PBP_COLUMNS           = ["period", "clock_decimal", "event_type", "attribution_id",
+                         "players", "statistics", "expected_goals", "details_distance"]
+
+# Distance-bucket xG: shots at <=10ft score 0.20, <=20ft 0.12, ... >40ft 0.02
+XG_BIN_EDGES = np.array([10, 20, 30, 40])
+XG_BASE      = np.array([0.20, 0.12, 0.08, 0.04, 0.02])
 
 # --- Testing Feature Flag ---
 TEST_MODE       = True
@@ -29,123 +52,323 @@ HEADERS = {
     "x-api-key": SPORTSRADAR_API_KEY
 }
 
+# --- HTTP Session ---
+
+class RateLimiter:
+    """Token bucket refilled at `rate` tokens/sec, shared across threads."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate        = rate
+        self.capacity    = capacity
+        self.tokens      = capacity
+        self.last_refill = time.monotonic()
+        self.lock        = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """HTTPAdapter that takes a limiter token before each request goes out."""
+
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+LIMITER = RateLimiter(MAX_REQUESTS_PER_SECOND)
+
+
+def cache_filter(response):
+    """Only cache play-by-play once the game is final; it changes until then."""
+    if not response.url.endswith("/pbp.json"):
+        return True
+    try:
+        return response.json().get("status") in FINAL_GAME_STATUSES
+    except ValueError:
+        return False
+
+# One pooled session so keep-alive connections and TLS handshakes are reused
+# across every request instead of reconnecting per call. 429s are left to
+# api_get so the server's Retry-After is honoured.
+#
+# Responses are cached on disk: play-by-play for final games and player
+# profiles never change, so re-runs only hit the network for new URLs.
+# Play-by-play for scheduled or in-progress games is never stored, and the
+# schedule is refreshed daily. Cache hits never reach the adapter, so they
+# don't consume rate-limit tokens.
+SESSION = CachedSession(
+    CACHE_PATH,
+    expire_after=NEVER_EXPIRE,
+    urls_expire_after={"*/schedule.json": timedelta(days=1)},
+    allowable_methods=("GET",),
+    filter_fn=cache_filter,
+)
+SESSION.mount("https://", RateLimitedAdapter(
+    LIMITER,
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+    ),
+))
+SESSION.headers.update(HEADERS)
+
 
 # --- Helpers ---
 
-def clock_to_seconds(clock_str, period):
-    """Convert MM:SS-left-in-period to cumulative seconds since puck-drop."""
-    m, s = map(int, clock_str.split(":"))
-    left = m * 60 + s
+def api_get(url):
+    """GET a JSON endpoint, backing off on HTTP 429 per Retry-After."""
+    for attempt in range(MAX_429_RETRIES):
+        resp = SESSION.get(url, timeout=REQUEST_TIMEOUT)
+        if resp.status_code != 429 or attempt == MAX_429_RETRIES - 1:
+            break
+        retry_after = resp.headers.get("Retry-After", "")
+        delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+        logger.warning("Rate limited on %s — retrying in %ds", url, delay)
+        time.sleep(delay)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def clocks_to_seconds(clocks, periods):
+    """Convert MM:SS-left-in-period clocks to cumulative seconds since puck-drop."""
+    clocks = np.asarray(clocks, dtype=str)
+    if not clocks.size:
+        return np.empty(0, dtype=np.int32)
+    parts = np.char.partition(clocks, ":")
+    left  = parts[:, 0].astype(np.int32) * 60 + parts[:, 2].astype(np.int32)
     elapsed = PERIOD_LENGTH_SECONDS - left
-    return (period - 1) * PERIOD_LENGTH_SECONDS + elapsed
+    return (np.asarray(periods, dtype=np.int32) - 1) * PERIOD_LENGTH_SECONDS + elapsed
 
 
-def estimate_xg(event):
-    """Get expected goals from API or distance buckets."""
-    if "expected_goals" in event:
-        return event["expected_goals"]
-    dist = event.get("details", {}).get("distance")
-    if dist is None:
-        return 0.0
-    if dist <= 10:   return 0.20
-    if dist <= 20:   return 0.12
-    if dist <= 30:   return 0.08
-    if dist <= 40:   return 0.04
-    return 0.02
+def estimate_xg(shots):
+    """Get expected goals for a frame of shot plays from API or distance buckets."""
+    api  = shots["expected_goals"].to_numpy(dtype=float)
+    dist = shots["details_distance"].to_numpy(dtype=float)
+    # side="left" puts a shot exactly on an edge in the closer bucket
+    xg = XG_BASE[np.searchsorted(XG_BIN_EDGES, dist)]
+    xg[np.isnan(dist)] = 0.0
+    return np.where(np.isnan(api), xg, api)
 
 
 def fetch_schedule():
     """Fetch the list of games for the season."""
     url = f"{SPORTSRADAR_BASE_URL}/games/{SEASON}/REG/schedule.json"
     logger.info("Fetching schedule for season %s REG...", SEASON)
-    resp = requests.get(url, headers=HEADERS)
-    resp.raise_for_status()
-    games = resp.json().get("games", [])
+    games = api_get(url).get("games", [])
     logger.info(" → Retrieved %d games", len(games))
     return games
 
 
 def fetch_game_pbp(game_id):
-    """Fetch and flatten play-by-play events for one game."""
+    """
+    Fetch and flatten play-by-play events for one game.
+    Returns a DataFrame with one row per event and nested fields joined
+    by "_" (e.g. attribution_id, details_distance), plus clock_seconds.
+    """
     url = f"{SPORTSRADAR_BASE_URL}/games/{game_id}/pbp.json"
-    resp = requests.get(url, headers=HEADERS)
-    resp.raise_for_status()
-    data = resp.json()
+    data = api_get(url)
     plays = []
     for period in data.get("periods", []):
         for ev in period.get("events", []):
             ev["period"] = period["number"]
             plays.append(ev)
+    plays = pd.json_normalize(plays, sep="_")
+    plays = plays.reindex(columns=plays.columns.union(PBP_COLUMNS, sort=False))
+    # parse each clock once; shifts and shots both read clock_seconds
+    plays["clock_seconds"] = clocks_to_seconds(plays["clock_decimal"].to_numpy(),
+                                               plays["period"].to_numpy())
     return plays
 
 
-def parse_shifts(plays, home_id, away_id):
+@njit(cache=True)
+def _build_shifts(sub_times, sub_side, sub_bits, sub_offsets,
+                  side_players, n_players, final_t):
     """
-    Reconstruct on-ice shift intervals from substitution events.
-    Returns dict[player_id] -> list of (start_sec, end_sec).
+    Run the substitution state machine over dense player indices.
+    Each side's on-ice group is an int64 bitmask; bit b of side sd is
+    player side_players[sd, b].
+    Returns (player_idx, start, end) arrays in the order shifts close.
     """
-    subs = [ev for ev in plays if ev.get("event_type") == "substitution"]
-    if not subs:
-        return defaultdict(list)
-
-    def side(tid):
-        return "home" if tid == home_id else "away"
-
-    subs_sorted = sorted(
-        subs,
-        key=lambda ev: clock_to_seconds(ev["clock_decimal"], ev["period"])
-    )
-
-    shifts = defaultdict(list)
-    on_ice = {"home": set(), "away": set()}
-    shift_start = {}
-
-    for ev in subs_sorted:
-        t0      = clock_to_seconds(ev["clock_decimal"], ev["period"])
-        team_id = ev["attribution"]["id"]
-        sd      = side(team_id)
-        group   = {p["id"] for p in ev["players"]}
+    on_ice      = np.zeros(2, dtype=np.int64)
+    shift_start = np.full(n_players, -1, dtype=np.int32)
+
+    # every shift is opened by a player's appearance in some group
+    out_pid   = np.empty(len(sub_bits), dtype=np.int32)
+    out_start = np.empty(len(sub_bits), dtype=np.int32)
+    out_end   = np.empty(len(sub_bits), dtype=np.int32)
+    n = 0
+
+    for e in range(len(sub_times)):
+        t0    = sub_times[e]
+        sd    = sub_side[e]
+        group = np.int64(0)
+        for bit in sub_bits[sub_offsets[e]:sub_offsets[e + 1]]:
+            group |= np.int64(1) << bit
 
         # close existing shifts for players who left
-        for pid in on_ice[sd] - group:
-            start = shift_start.pop(pid, None)
-            if start is not None:
-                shifts[pid].append((start, t0))
+        left = on_ice[sd] & ~group
+        b = 0
+        while left:
+            if left & 1:
+                p = side_players[sd, b]
+                if shift_start[p] >= 0:
+                    out_pid[n]     = p
+                    out_start[n]   = shift_start[p]
+                    out_end[n]     = t0
+                    shift_start[p] = -1
+                    n += 1
+            left >>= 1
+            b += 1
 
         # open shifts for new players
-        for pid in group - on_ice[sd]:
-            shift_start[pid] = t0
+        entered = group & ~on_ice[sd]
+        b = 0
+        while entered:
+            if entered & 1:
+                shift_start[side_players[sd, b]] = t0
+            entered >>= 1
+            b += 1
 
         on_ice[sd] = group
 
-    # determine end-of-game time from all plays
-    all_times = [
-        clock_to_seconds(ev["clock_decimal"], ev["period"])
-        for ev in plays
-    ]
-    final_t = max(all_times) if all_times else 0
-
     # close any still-open shifts at final timestamp
-    for pid, start in shift_start.items():
-        shifts[pid].append((start, final_t))
+    for p in range(n_players):
+        if shift_start[p] >= 0:
+            out_pid[n]   = p
+            out_start[n] = shift_start[p]
+            out_end[n]   = final_t
+            n += 1
+
+    return out_pid[:n], out_start[:n], out_end[:n]
+
+
+@njit(cache=True)
+def _on_ice_many(shot_t, starts, ends, offsets):
+    """Boolean [shots, players] matrix of whether each player is on ice."""
+    n_players = len(offsets) - 1
+    covered = np.zeros((len(shot_t), n_players), dtype=np.bool_)
+    for p in range(n_players):
+        lo, hi = offsets[p], offsets[p + 1]
+        for s in range(len(shot_t)):
+            # last shift starting at or before t is the only one that can cover it
+            k = np.searchsorted(starts[lo:hi], shot_t[s], side="right") - 1
+            covered[s, p] = k >= 0 and ends[lo + k] >= shot_t[s]
+    return covered
 
-    return shifts
 
+def parse_shifts(plays, home_id, away_id):
+    """
+    Reconstruct on-ice shift intervals and rosters from substitution events.
+    Returns (shifts, home_roster, away_roster):
+      shifts  -- (player_ids, offsets, starts, ends); shifts of player_ids[i]
+                 are starts[offsets[i]:offsets[i+1]] / ends[...], sorted by time
+      rosters -- int arrays of indices into player_ids for each side
+    """
+    sub_idx = np.flatnonzero((plays["event_type"] == "substitution").to_numpy())
+    if not len(sub_idx):
+        empty = np.empty(0, dtype=np.int32)
+        return ([], np.zeros(1, dtype=np.int64), empty, empty), empty, empty
+
+    secs    = plays["clock_seconds"].to_numpy()
+    sub_idx = sub_idx[np.argsort(secs[sub_idx], kind="stable")]
+    sub_team    = plays["attribution_id"].to_numpy()[sub_idx]
+    sub_players = plays["players"].to_numpy()[sub_idx]
+
+    # encode subs as flat arrays: each player gets a dense index, and a bit
+    # in the on-ice mask of every side they're listed for; the players behind
+    # each side's bits are that side's roster
+    index, bits = {}, {}
+    side_players = ([], [])
+    sub_side, sub_bits, sub_offsets = [], [], [0]
+    for team_id, players in zip(sub_team, sub_players):
+        sd = 0 if team_id == home_id else 1
+        for p in players:
+            key = (sd, p["id"])
+            if key not in bits:
+                bits[key] = len(side_players[sd])
+                side_players[sd].append(index.setdefault(p["id"], len(index)))
+            sub_bits.append(bits[key])
+        sub_side.append(sd)
+        sub_offsets.append(len(sub_bits))
+
+    max_side = max(len(side_players[0]), len(side_players[1]))
+    if max_side > MAX_SIDE_PLAYERS:
+        raise ValueError(f"{max_side} players on one side exceeds the "
+                         f"{MAX_SIDE_PLAYERS}-bit on-ice mask")
+    side_table = np.zeros((2, max_side), dtype=np.int32)
+    for sd in (0, 1):
+        side_table[sd, :len(side_players[sd])] = side_players[sd]
+
+    # end-of-game time is the latest clock across all plays
+    final_t = int(secs.max())
+
+    pid, start, end = _build_shifts(
+        secs[sub_idx].astype(np.int32),
+        np.asarray(sub_side, dtype=np.int8),
+        np.asarray(sub_bits, dtype=np.int64),
+        np.asarray(sub_offsets, dtype=np.int64),
+        side_table,
+        len(index),
+        final_t,
+    )
+
+    # group by player; the stable sort keeps each player's shifts in time order
+    order   = np.argsort(pid, kind="stable")
+    offsets = np.searchsorted(pid[order], np.arange(len(index) + 1))
+    shifts  = (list(index), offsets, start[order], end[order])
+    return shifts, side_table[0, :len(side_players[0])], side_table[1, :len(side_players[1])]
 
 
-def on_off_ice(shifts, t, atk_id, home_roster, away_roster, home_id):
+def extract_shots(plays):
     """
-    Given timestamp t and attacking team id, classify each defender
-    as on-ice or off-ice.
+    Pull shot statistics out of a play-by-play frame.
+    Returns (shot_plays, shot_atk): the play row behind each shot and the id
+    of the shooting team.
     """
-    defenders = away_roster if atk_id == home_id else home_roster
-    on_, off_ = [], []
-    for pid in defenders:
-        if any(s <= t <= e for s, e in shifts.get(pid, [])):
-            on_.append(pid)
-        else:
-            off_.append(pid)
-    return on_, off_
+    stats = plays["statistics"].explode().dropna()
+    if stats.empty:
+        return plays.iloc[:0], np.empty(0, dtype=object)
+    stats = pd.json_normalize(stats.tolist(), sep="_").set_index(stats.index)
+    shots = stats[stats["type"] == "shot"]
+    return plays.loc[shots.index], shots["team_id"].to_numpy()
+
+
+def classify_shots(shifts, shot_t, shot_atk, home_roster, away_roster, home_id):
+    """
+    Classify every defender as on-ice or off-ice for a batch of shots.
+    Rosters are index arrays into the shifts' player_ids, as from parse_shifts.
+    Returns (shot_idx, player_ids, on) arrays, one entry per shot/defender pair.
+    """
+    player_ids, offsets, starts, ends = shifts
+    covered = _on_ice_many(shot_t.astype(np.int32), starts, ends, offsets)
+
+    cols    = np.concatenate([home_roster, away_roster])
+    is_home = np.arange(len(cols)) < len(home_roster)
+
+    # defenders are the roster of the team that isn't shooting
+    def_home = np.asarray(shot_atk) != home_id
+    shot_idx, p_idx = np.nonzero(is_home[None, :] == def_home[:, None])
+    players = cols[p_idx]
+    return shot_idx, np.asarray(player_ids, dtype=object)[players], covered[shot_idx, players]
 
 
 # --- Main Script ---
@@ -157,48 +380,56 @@ if __name__ == "__main__":
         games = games[:TEST_GAME_LIMIT]
 
     csv_path = "nhl_defense_shot_data.csv"
-    with open(csv_path, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["game_id", "period", "clock_seconds", "player_id", "on_off", "xg"])
+    with open(csv_path, "wb", buffering=1 << 20) as csvfile:
+        # \r\n line endings, as csv.writer produced for this file originally
+        csvfile.write((",".join(CSV_COLUMNS) + "\r\n").encode())
 
         total_rows = 0
-        for game in games:
-            gid     = game["id"]
-            home_id = game["home"]["id"]
-            away_id = game["away"]["id"]
-
-            logger.info("Processing game %s", gid)
-            pbp    = fetch_game_pbp(gid)
-            shifts = parse_shifts(pbp, home_id, away_id)
-
-            # build rosters from substitutions
-            rosters = {"home": set(), "away": set()}
-            for ev in pbp:
-                if ev.get("event_type") == "substitution":
-                    sd = "home" if ev["attribution"]["id"] == home_id else "away"
-                    rosters[sd].update(p["id"] for p in ev["players"])
-            home_roster = rosters["home"]
-            away_roster = rosters["away"]
-
-            shots, rows = 0, 0
-            for ev in pbp:
-                for stat in ev.get("statistics", []):
-                    if stat.get("type") != "shot":
-                        continue
-                    shots += 1
-                    t_ev   = clock_to_seconds(ev["clock_decimal"], ev["period"])
-                    xg     = estimate_xg(ev)
-                    atk_id = stat["team"]["id"]
-
-                    on_d, off_d = on_off_ice(shifts, t_ev, atk_id, home_roster, away_roster, home_id)
-                    for pid in on_d:
-                        writer.writerow([gid, ev["period"], t_ev, pid, "on",  xg])
-                        rows += 1
-                    for pid in off_d:
-                        writer.writerow([gid, ev["period"], t_ev, pid, "off", xg])
-                        rows += 1
-
-            total_rows += rows
-            logger.info(" → shots=%d, rows_added=%d, cumulative_rows=%d", shots, rows, total_rows)
+        # fetch play-by-play concurrently; parsing and CSV writing stay on
+        # this thread so writes to the file are never interleaved
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futures = {ex.submit(fetch_game_pbp, g["id"]): g for g in games}
+            try:
+                for fut in as_completed(futures):
+                    # pop so each game's play-by-play is freed once parsed
+                    game    = futures.pop(fut)
+                    gid     = game["id"]
+                    home_id = game["home"]["id"]
+                    away_id = game["away"]["id"]
+
+                    logger.info("Processing game %s", gid)
+                    pbp = fut.result()
+                    shifts, home_roster, away_roster = parse_shifts(pbp, home_id, away_id)
+
+                    shot_plays, shot_atk = extract_shots(pbp)
+
+                    shots, rows = len(shot_plays), 0
+                    if shots:
+                        shot_period = shot_plays["period"].to_numpy(dtype=np.int32)
+                        shot_t  = shot_plays["clock_seconds"].to_numpy()
+                        shot_xg = estimate_xg(shot_plays)
+
+                        idx, pids, on = classify_shots(shifts, shot_t, shot_atk,
+                                                       home_roster, away_roster, home_id)
+                        # every field is numeric or a UUID/on/off token, so rows
+                        # need no CSV quoting and can be formatted directly
+                        csvfile.write("".join(
+                            f"{gid},{period},{t},{pid},{on_off},{xg}\r\n"
+                            for period, t, pid, on_off, xg in zip(
+                                shot_period[idx].tolist(),
+                                shot_t[idx].tolist(),
+                                pids,
+                                np.where(on, "on", "off"),
+                                shot_xg[idx].tolist(),
+                            )
+                        ).encode())
+                        rows = len(idx)
+
+                    total_rows += rows
+                    logger.info(" → shots=%d, rows_added=%d, cumulative_rows=%d", shots, rows, total_rows)
+            except BaseException:
+                # don't wait on queued fetches before surfacing the error
+                ex.shutdown(cancel_futures=True)
+                raise
 
     logger.info("Done. Wrote %d rows to %s", total_rows, csv_path)
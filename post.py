@@ -1,49 +1,52 @@
-import pandas as pd
-import os
-import requests
-import time
+import polars as pl
+from concurrent.futures import ThreadPoolExecutor
 
-SPORTSRADAR_BASE_URL  = "https://api.sportradar.us/nhl/production/v7/en"
-SPORTSRADAR_API_KEY   = os.getenv("SPORTSRADAR_API_KEY")
+from main import api_get, MAX_WORKERS, SPORTSRADAR_BASE_URL
 
-# 1) Read in the shot‐data
-df = pd.read_csv("nhl_defense_shot_data.csv")
 
-# 2) Aggregate on/off ice xG totals
+def fetch_player_name(pid):
+    """Look up a player's full name from their Sportradar profile."""
+    url = f"{SPORTSRADAR_BASE_URL}/players/{pid}/profile.json"
+    return api_get(url)["full_name"]
+
+
+# 1) Read in the shot‐data and aggregate on/off ice shot attempts and xG totals
+is_on  = pl.col("on_off") == "on"
+is_off = pl.col("on_off") == "off"
 agg = (
-    df
-    .groupby(["player_id","on_off"])
-    .agg(att=("xg","count"), xga=("xg","sum"))
-    .unstack(fill_value=0)
+    pl.scan_csv("nhl_defense_shot_data.csv")
+    .group_by("player_id")
+    .agg(
+        on_att  = is_on.sum(),
+        off_att = is_off.sum(),
+        on_xga  = pl.col("xg").filter(is_on).sum(),
+        off_xga = pl.col("xg").filter(is_off).sum(),
+    )
+    # 2) Compute exp aSV% and delta
+    .with_columns(
+        expASV_on  = 1 - pl.col("on_xga")  / pl.col("on_att"),
+        expASV_off = 1 - pl.col("off_xga") / pl.col("off_att"),
+    )
+    .with_columns(delta_expASV = pl.col("expASV_on") - pl.col("expASV_off"))
+    # a player with no on- or off-ice shots divides 0/0; write those as
+    # empty fields like pandas did, not as NaN
+    .with_columns(pl.col("expASV_on", "expASV_off", "delta_expASV").fill_nan(None))
+    # keep the results ordered by player_id, as the pandas groupby did
+    .sort("player_id")
+    .collect()
 )
-agg.columns = [f"{side}_{metric}" for metric,side in agg.columns]
 
-# 3) Compute exp aSV% and delta
-agg["expASV_on"]   = 1 - agg["on_xga"]  / agg["on_att"]
-agg["expASV_off"]  = 1 - agg["off_xga"] / agg["off_att"]
-agg["delta_expASV"]= agg["expASV_on"]   - agg["expASV_off"]
-
-# 4) Fetch player names from NHL Stats API
-player_ids = agg.index.tolist()
-name_map = {}
-for pid in player_ids:
-    url = f"{SPORTSRADAR_BASE_URL}/players/{pid}/profile.json"
-    header = {
-    "accept": "application/json",
-    "x-api-key": SPORTSRADAR_API_KEY
-    }
-    resp = requests.get(url, headers=header)
-    resp.raise_for_status()
-    name = resp.json()["full_name"]
-    name_map[pid] = name
-    time.sleep(3)
+# 3) Fetch player names concurrently; api_get's shared limiter keeps the
+#    combined request rate under MAX_REQUESTS_PER_SECOND
+player_ids = agg["player_id"].to_list()
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+    name_map = dict(zip(player_ids, ex.map(fetch_player_name, player_ids)))
 
-# 5) Build final DataFrame and write to CSV
+# 4) Build final DataFrame and write to CSV
 out = (
     agg
-    .reset_index()
-    .assign(player_name = lambda d: d["player_id"].map(name_map))
-    .loc[:, ["player_name","expASV_on","expASV_off","delta_expASV"]]
+    .with_columns(player_name = pl.col("player_id").replace_strict(name_map))
+    .select(["player_name","expASV_on","expASV_off","delta_expASV"])
 )
-out.to_csv("delta_exp_asv_results.csv", index=False)
+out.write_csv("delta_exp_asv_results.csv")
 print("Wrote", len(out), "rows to delta_exp_asv_results.csv")